@@ -1,16 +1,20 @@
 """Musify Backend API - Spotify playlist to ZIP downloader."""
 
 import asyncio
+import heapq
 import logging
+import os
 import time
 import uuid
+from collections import OrderedDict, deque
 from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
 
+import orjson
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from services.spotdl_service import SpotDLService, DownloadProgress, DownloadResult
@@ -22,31 +26,75 @@ logger = logging.getLogger(__name__)
 # Auto-cleanup interval (30 minutes = 1800 seconds)
 CLEANUP_AFTER_SECONDS = 1800
 
+# Max progress updates coalesced into one websocket frame
+WS_BATCH_SIZE = 128
+
+# Jobs downloading at once (each may run PROVIDER_CONCURRENCY spotdl processes);
+# the rest stay "pending" until a slot frees up
+MAX_CONCURRENT_DOWNLOADS = min(4, os.cpu_count() or 1)
+
+# Least recently used jobs are evicted beyond this many
+MAX_JOBS = 100
+
+# Progress updates kept per job for /api/status and late websocket joiners
+PROGRESS_HISTORY = 256
+
 # Services
 spotdl_service = SpotDLService()
 zip_service = ZipService()
 
-# In-memory job storage with timestamps
-jobs: dict[str, dict] = {}
+# In-memory job storage with timestamps, ordered least recently used first
+jobs: OrderedDict[str, dict] = OrderedDict()
+
+# Min-heap of (expires_at, job_id), pushed when a job finishes, so cleanup
+# only touches expired jobs
+_expiry_heap: list[tuple[float, str]] = []
+
+# Running _process_download tasks by job_id, cancelled on removal and shutdown
+_download_tasks: dict[str, asyncio.Task] = {}
+
+_download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+
+def _publish(job: dict, update: Optional[dict]) -> None:
+    """Push a progress update (or the end-of-stream sentinel) to live listeners."""
+    item = None
+    if update is not None:
+        job["seq"] += 1
+        job["progress"].append(update)
+        item = (job["seq"], update)
+    for queue in job["listeners"]:
+        queue.put_nowait(item)
+
+
+def _remove_job(job_id: str) -> None:
+    """Delete a job's files and record, and end its websocket streams."""
+    # Stop the download first so its provider race unwinds instead of
+    # finding the job directory gone underneath it
+    task = _download_tasks.pop(job_id, None)
+    if task:
+        task.cancel()
+    spotdl_service.cleanup_job(job_id)
+    _publish(jobs.pop(job_id), None)
 
 
 async def cleanup_old_jobs():
-    """Background task to clean up jobs older than 30 minutes."""
+    """Background task to clean up jobs 30 minutes after they finish."""
     while True:
-        await asyncio.sleep(60)  # Check every minute
-        current_time = time.time()
-        jobs_to_delete = []
-        
-        for job_id, job in jobs.items():
-            if current_time - job.get("created_at", current_time) > CLEANUP_AFTER_SECONDS:
-                jobs_to_delete.append(job_id)
+        # Every entry has the same TTL, so new entries always expire after the
+        # current heap head and never need an earlier wakeup
+        delay = _expiry_heap[0][0] - time.time() if _expiry_heap else CLEANUP_AFTER_SECONDS
+        await asyncio.sleep(max(delay, 1))
         
-        for job_id in jobs_to_delete:
-            logger.info(f"Auto-cleaning job {job_id} (older than 30 mins)")
+        current_time = time.time()
+        while _expiry_heap and _expiry_heap[0][0] <= current_time:
+            _, job_id = heapq.heappop(_expiry_heap)
+            if job_id not in jobs:
+                continue  # Already deleted via the API
+            
+            logger.info(f"Auto-cleaning job {job_id} (finished over 30 mins ago)")
             try:
-                spotdl_service.cleanup_job(job_id)
-                zip_service.cleanup_zip(job_id)
-                del jobs[job_id]
+                _remove_job(job_id)
             except Exception as e:
                 logger.error(f"Error cleaning job {job_id}: {e}")
 
@@ -58,8 +106,13 @@ async def lifespan(app: FastAPI):
     cleanup_task = asyncio.create_task(cleanup_old_jobs())
     logger.info("Started auto-cleanup task (30 min TTL)")
     yield
-    # Cancel cleanup task on shutdown
+    # Cancel background tasks on shutdown and wait for them to unwind, so
+    # spotdl processes get killed and no pending task is left behind
     cleanup_task.cancel()
+    download_tasks = list(_download_tasks.values())
+    for task in download_tasks:
+        task.cancel()
+    await asyncio.gather(cleanup_task, *download_tasks, return_exceptions=True)
 
 
 app = FastAPI(
@@ -103,53 +156,82 @@ async def root():
 
 @app.post("/api/download", response_model=DownloadResponse)
 async def start_download(request: DownloadRequest):
-    if not spotdl_service.validate_spotify_url(request.url):
+    clean_url = spotdl_service.parse_url(request.url)
+    if not clean_url:
         raise HTTPException(status_code=400, detail="Invalid Spotify URL")
     
+    while len(jobs) >= MAX_JOBS:
+        evicted_id = next(iter(jobs))
+        logger.info(f"Evicting least recently used job {evicted_id}")
+        _remove_job(evicted_id)
+    
     job_id = str(uuid.uuid4())
     jobs[job_id] = {
         "status": "pending",
         "url": request.url,
-        "progress": [],
+        "progress": deque(maxlen=PROGRESS_HISTORY),
+        "seq": 0,  # Number of updates ever published, for client-side dedup
+        "listeners": set(),  # asyncio.Queue per connected websocket
+        "files": [],
         "song_count": 0,
         "error": None,
-        "created_at": time.time()  # Track creation time for cleanup
+        "created_at": time.time()
     }
     
-    asyncio.create_task(_process_download(job_id, request.url))
+    task = asyncio.create_task(_process_download(job_id, clean_url))
+    _download_tasks[job_id] = task
+    task.add_done_callback(lambda _: _download_tasks.pop(job_id, None))
     
     return DownloadResponse(
         job_id=job_id,
-        message="Download started. Files auto-delete after 30 minutes."
+        message="Download started. Files auto-delete 30 minutes after it finishes."
     )
 
 
 async def _process_download(job_id: str, url: str):
-    jobs[job_id]["status"] = "downloading"
-    result: Optional[DownloadResult] = None
-    
-    async for update in spotdl_service.download_playlist(url, job_id):
-        if isinstance(update, DownloadProgress):
-            jobs[job_id]["progress"].append({
-                "song": update.song_name,
-                "status": update.status,
-                "message": update.message
-            })
-        elif isinstance(update, DownloadResult):
-            result = update
-    
-    if result and result.success:
-        files = spotdl_service.get_job_files(job_id)
-        if files:
-            zip_service.create_zip(job_id, files)
-            jobs[job_id]["status"] = "completed"
-            jobs[job_id]["song_count"] = result.song_count
-        else:
-            jobs[job_id]["status"] = "error"
-            jobs[job_id]["error"] = "No songs downloaded"
-    else:
-        jobs[job_id]["status"] = "error"
-        jobs[job_id]["error"] = result.error if result else "Download failed"
+    job = jobs[job_id]
+    
+    try:
+        # Stay "pending" until a download slot is free
+        async with _download_semaphore:
+            if job_id not in jobs:
+                return  # Deleted or evicted while waiting
+            
+            job["status"] = "downloading"
+            result: Optional[DownloadResult] = None
+            
+            async for update in spotdl_service.download_playlist(url, job_id):
+                if isinstance(update, DownloadProgress):
+                    _publish(job, {
+                        "song": update.song_name,
+                        "status": update.status,
+                        "message": update.message
+                    })
+                elif isinstance(update, DownloadResult):
+                    result = update
+            
+            if result and result.success:
+                if result.files:
+                    job["files"] = result.files  # Zipped on the fly by download_zip
+                    job["status"] = "completed"
+                    job["song_count"] = result.song_count
+                else:
+                    job["status"] = "error"
+                    job["error"] = "No songs downloaded"
+            else:
+                job["status"] = "error"
+                job["error"] = result.error if result else "Download failed"
+    except Exception as e:
+        # e.g. the save file or a downloaded MP3 couldn't be written
+        logger.exception(f"Download crashed for job {job_id}")
+        job["status"] = "error"
+        job["error"] = str(e) or "Download failed"
+    finally:
+        # Wake websocket listeners so they can send the final status
+        _publish(job, None)
+        # The TTL starts once the job is finished, so time spent queued or
+        # downloading doesn't eat into the window for fetching the ZIP
+        heapq.heappush(_expiry_heap, (time.time() + CLEANUP_AFTER_SECONDS, job_id))
 
 
 @app.get("/api/status/{job_id}", response_model=JobStatus)
@@ -157,13 +239,14 @@ async def get_status(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     
+    jobs.move_to_end(job_id)
     job = jobs[job_id]
     download_url = f"/api/download/{job_id}/zip" if job["status"] == "completed" else None
     
     return JobStatus(
         job_id=job_id,
         status=job["status"],
-        progress=job["progress"],
+        progress=list(job["progress"]),
         song_count=job["song_count"],
         download_url=download_url,
         error=job["error"]
@@ -175,17 +258,20 @@ async def download_zip(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     
+    jobs.move_to_end(job_id)
     if jobs[job_id]["status"] != "completed":
         raise HTTPException(status_code=400, detail="Download not complete")
     
-    zip_path = zip_service.get_zip_path(job_id)
-    if not zip_path or not zip_path.exists():
-        raise HTTPException(status_code=404, detail="ZIP file not found")
+    # File list cached when the job completed; no directory scan per request
+    files = jobs[job_id]["files"]
+    if not files:
+        raise HTTPException(status_code=404, detail="Downloaded files not found")
     
-    return FileResponse(
-        path=zip_path,
-        filename=zip_path.name,
-        media_type="application/zip"
+    # Sync iterators are consumed on Starlette's threadpool, off the event loop
+    return StreamingResponse(
+        zip_service.stream_zip(files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{job_id}.zip"'}
     )
 
 
@@ -194,47 +280,70 @@ async def cleanup_job(job_id: str):
     if job_id not in jobs:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    spotdl_service.cleanup_job(job_id)
-    zip_service.cleanup_zip(job_id)
-    del jobs[job_id]
+    _remove_job(job_id)
     
     return {"message": "Job cleaned up"}
 
 
+async def _send_json(websocket: WebSocket, payload: dict) -> None:
+    """Send a JSON text frame encoded with orjson instead of the stdlib json module."""
+    # Text rather than binary frames so browsers still get a string for JSON.parse
+    await websocket.send_text(orjson.dumps(payload).decode())
+
+
 @app.websocket("/ws/{job_id}")
 async def websocket_progress(websocket: WebSocket, job_id: str):
     await websocket.accept()
     
+    if job_id not in jobs:
+        await _send_json(websocket, {"error": "Job not found"})
+        return
+    
+    jobs.move_to_end(job_id)
+    job = jobs[job_id]
+    queue: asyncio.Queue = asyncio.Queue()
+    job["listeners"].add(queue)
+    # Snapshot before the first await so no update is missed or sent twice
+    backlog = list(job["progress"])
+    seq = job["seq"]
+    finished = job["status"] in ["completed", "error"]
+    
     try:
-        last_progress_count = 0
-        while True:
-            if job_id not in jobs:
-                await websocket.send_json({"error": "Job not found"})
-                break
-            
-            job = jobs[job_id]
-            current_progress = job["progress"]
-            
-            if len(current_progress) > last_progress_count:
-                for update in current_progress[last_progress_count:]:
-                    await websocket.send_json(update)
-                last_progress_count = len(current_progress)
-            
-            if job["status"] in ["completed", "error"]:
-                await websocket.send_json({
-                    "status": job["status"],
-                    "song_count": job["song_count"],
-                    "download_url": f"/api/download/{job_id}/zip" if job["status"] == "completed" else None,
-                    "error": job["error"]
-                })
-                break
-            
-            await asyncio.sleep(0.5)
+        # Catch up in one frame; "seq" counts every update published so far
+        await _send_json(websocket, {"snapshot": backlog, "seq": seq})
+        
+        # Sleep until the download task publishes, then drain whatever else is
+        # already queued into the same frame; None marks end of stream
+        while not finished:
+            batch = []
+            item = await queue.get()
+            while item is not None:
+                seq, update = item
+                batch.append(update)
+                if len(batch) >= WS_BATCH_SIZE or queue.empty():
+                    break
+                item = queue.get_nowait()
+            if batch:
+                await _send_json(websocket, {"updates": batch, "seq": seq})
+            finished = item is None
+        
+        if job_id not in jobs:
+            await _send_json(websocket, {"error": "Job not found"})
+        else:
+            await _send_json(websocket, {
+                "status": job["status"],
+                "song_count": job["song_count"],
+                "download_url": f"/api/download/{job_id}/zip" if job["status"] == "completed" else None,
+                "error": job["error"]
+            })
     
     except WebSocketDisconnect:
         pass
+    finally:
+        job["listeners"].discard(queue)
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # permessage-deflate shrinks the repetitive JSON progress frames
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=True)
@@ -1,12 +1,15 @@
 """SpotDL service with multi-provider fallback."""
 
 import asyncio
+import json
 import logging
 import os
 import re
 import shutil
+import signal
+import threading
 import uuid
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import AsyncGenerator, Optional
 
@@ -16,6 +19,14 @@ logger = logging.getLogger(__name__)
 # Audio providers to try in order
 AUDIO_PROVIDERS = ["youtube-music", "youtube", "soundcloud", "piped", "bandcamp"]
 
+# Providers raced at once; the rest wait for a slot in order
+PROVIDER_CONCURRENCY = 2
+
+# A spotdl run silent for this long is assumed hung and killed, which fails
+# that provider so the next one gets its turn. It bounds silence rather than
+# total runtime so large playlists that keep printing songs are not cut short.
+PROVIDER_IDLE_TIMEOUT_SECONDS = 300
+
 
 @dataclass
 class DownloadProgress:
@@ -32,28 +43,96 @@ class DownloadResult:
     output_dir: Path
     song_count: int
     error: Optional[str] = None
+    files: list[Path] = field(default_factory=list)
+
+
+def _kill(process: asyncio.subprocess.Process) -> None:
+    """SIGKILL a spotdl process and its children (it leads its own process group)."""
+    if process.returncode is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _list_mp3s(directory: Path) -> list[Path]:
+    """List MP3 files in a directory with a single scandir pass (no per-entry stat)."""
+    with os.scandir(directory) as entries:
+        return [Path(e.path) for e in entries if e.name.endswith(".mp3") and e.is_file()]
 
 
 class SpotDLService:
     DOWNLOADS_DIR = Path("downloads")
     COOKIES_FILE = Path("cookies.txt")
     SPOTIFY_URL_PATTERN = re.compile(
-        r'^https://open\.spotify\.com/(playlist|album|track)/[a-zA-Z0-9]+(\?.*)?$'
+        r'^(https://open\.spotify\.com/(playlist|album|track)/[a-zA-Z0-9]+)(\?.*)?$',
+        re.ASCII
     )
+    # spotdl prints `Downloaded "Artist - Title": <audio url>` per finished song
+    DOWNLOADED_PATTERN = re.compile(r'Downloaded "([^"]+)"')
     
     def __init__(self):
         self.DOWNLOADS_DIR.mkdir(exist_ok=True)
         self.client_id = os.environ.get("SPOTIFY_CLIENT_ID", "")
         self.client_secret = os.environ.get("SPOTIFY_CLIENT_SECRET", "")
+        # spotdl's SpotifyClient is a process-wide singleton, initialised on first use
+        self._spotify_lock = threading.Lock()
+        self._spotify_ready = False
+        # Running spotdl processes per job, killed by cleanup_job
+        self._processes: dict[str, set[asyncio.subprocess.Process]] = {}
+    
+    def parse_url(self, url: str) -> Optional[str]:
+        """Return the URL without its query string, or None if it is not a Spotify URL."""
+        match = self.SPOTIFY_URL_PATTERN.match(url)
+        return match.group(1) if match else None
     
-    def validate_spotify_url(self, url: str) -> bool:
-        return bool(self.SPOTIFY_URL_PATTERN.match(url))
+    def _fetch_songs(self, url: str) -> list:
+        """Resolve a Spotify URL to spotdl songs with the shared in-process client (blocking)."""
+        from spotdl.utils.config import DEFAULT_CONFIG
+        from spotdl.utils.search import get_simple_songs
+        from spotdl.utils.spotify import SpotifyClient
+        
+        with self._spotify_lock:
+            if not self._spotify_ready:
+                SpotifyClient.init(
+                    client_id=self.client_id or DEFAULT_CONFIG["client_id"],
+                    client_secret=self.client_secret or DEFAULT_CONFIG["client_secret"],
+                )
+                self._spotify_ready = True
+        
+        return get_simple_songs([url])
     
-    def _clean_url(self, url: str) -> str:
-        return url.split('?')[0]
+    async def _save_songs(self, url: str, output_dir: Path) -> str:
+        """
+        Resolve the URL's tracks once and write them to a .spotdl save file.
+        
+        Every provider attempt then downloads from the save file instead of
+        re-fetching playlist metadata from Spotify. Falls back to the URL itself
+        if the lookup fails.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            songs = await loop.run_in_executor(None, self._fetch_songs, url)
+        except Exception as e:
+            logger.warning(f"In-process Spotify lookup failed, providers will query the URL: {e}")
+            return url
+        
+        save_file = output_dir / "songs.spotdl"
+        save_file.write_text(
+            json.dumps([song.json for song in songs], ensure_ascii=False), encoding="utf-8"
+        )
+        return str(save_file)
     
-    async def _try_download(self, url: str, output_dir: Path, provider: str) -> int:
-        """Try downloading with a specific provider. Returns number of files downloaded."""
+    async def _try_download(
+        self, job_id: str, url: str, output_dir: Path, provider: str, progress: asyncio.Queue
+    ) -> list[Path]:
+        """
+        Try downloading with a specific provider.
+        
+        Songs are reported on the progress queue as spotdl finishes them, as
+        "downloading" since another provider may still win the race. Returns the
+        MP3s now in output_dir.
+        """
         cmd = [
             "spotdl", "download", url,
             "--output", str(output_dir),
@@ -69,29 +148,139 @@ class SpotDLService:
         
         logger.info(f"Trying provider: {provider}")
         
+        # Raced spotdl processes would share ~/.spotdl/temp and overwrite or delete
+        # each other's files, so each attempt gets its own home. It lives in the
+        # staging directory, so temp files left by a killed run go away with it.
+        home = (output_dir / "home").resolve()
+        home.mkdir(exist_ok=True)
+        env = {
+            **os.environ,
+            "HOME": str(home),
+            "XDG_DATA_HOME": str(home / ".local" / "share"),
+            # Rich wraps output to 80 columns on a pipe, splitting long song names
+            "COLUMNS": "1000",
+        }
+        
         process = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+            stderr=asyncio.subprocess.STDOUT,  # One merged stream, one reader
+            start_new_session=True,  # Own process group, so ffmpeg children can be killed too
+            env=env
         )
         
-        async def read_output(stream, name):
-            while True:
-                line = await stream.readline()
-                if not line: break
+        async def run():
+            while line := await asyncio.wait_for(
+                process.stdout.readline(), timeout=PROVIDER_IDLE_TIMEOUT_SECONDS
+            ):
                 text = line.decode('utf-8', errors='ignore').strip()
-                if text: logger.info(f"[{provider}] {text}")
+                if not text: continue
+                logger.info(f"[{provider}] {text}")
+                match = self.DOWNLOADED_PATTERN.search(text)
+                if match:
+                    progress.put_nowait(DownloadProgress(
+                        song_name=match.group(1), status="downloading", progress=50,
+                        message=f"Downloaded via {provider}: {match.group(1)}"
+                    ))
+            await asyncio.wait_for(process.wait(), timeout=PROVIDER_IDLE_TIMEOUT_SECONDS)
         
-        await asyncio.gather(
-            read_output(process.stdout, "stdout"),
-            read_output(process.stderr, "stderr")
-        )
-        await process.wait()
+        job_processes = self._processes.setdefault(job_id, set())
+        job_processes.add(process)
+        try:
+            await run()
+        except asyncio.TimeoutError:
+            raise RuntimeError(
+                f"spotdl produced no output for {PROVIDER_IDLE_TIMEOUT_SECONDS}s"
+            ) from None
+        finally:
+            # Hung, cancelled because another provider won, or failed reading
+            # output (e.g. an over-long line): never leave spotdl running
+            if process.returncode is None:
+                _kill(process)
+                await process.wait()
+            job_processes.discard(process)
+            if not job_processes and self._processes.get(job_id) is job_processes:
+                del self._processes[job_id]
         
-        return len(list(output_dir.glob("*.mp3")))
+        return _list_mp3s(output_dir)
+    
+    async def _download_with_fallback(
+        self, job_id: str, url: str, output_dir: Path, progress: asyncio.Queue
+    ) -> tuple[Optional[str], list[Path], list[str]]:
+        """
+        Race audio providers and keep the files of the highest-priority one that
+        downloads anything.
+        
+        Each provider writes into its own staging directory so concurrent spotdl
+        processes never touch the same file. The name must not start with a dot:
+        spotdl strips leading dots from every output path component. A provider
+        only wins once every provider ahead of it in AUDIO_PROVIDERS has finished
+        without files. Returns the winning provider (if any), its files moved into
+        output_dir, and the providers that were tried.
+        """
+        semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY)
+        tried_providers: list[str] = []
+        winner: Optional[str] = None
+        winner_files: list[Path] = []
+        tasks: list[asyncio.Task] = []
+        # Finished providers and what they downloaded; failures count as nothing
+        results: dict[str, list[Path]] = {}
+        
+        def settle():
+            nonlocal winner
+            if winner:
+                return
+            for provider in AUDIO_PROVIDERS:
+                if provider not in results:
+                    return  # Still running, and it outranks everything after it
+                files = results[provider]
+                if files:
+                    break
+            else:
+                return
+            
+            winner = provider
+            for f in files:
+                winner_files.append(f.replace(output_dir / f.name))
+            for task in tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+        
+        async def attempt(provider: str):
+            async with semaphore:
+                ahead = AUDIO_PROVIDERS[:AUDIO_PROVIDERS.index(provider)]
+                if any(results.get(p) for p in ahead):
+                    # A better provider already has files, so this one can't win
+                    results[provider] = []
+                    return
+                tried_providers.append(provider)
+                progress.put_nowait(DownloadProgress(
+                    song_name="", status="downloading", progress=10,
+                    message=f"Trying {provider}..."
+                ))
+                staging_dir = output_dir / f"_{provider}"
+                try:
+                    staging_dir.mkdir(exist_ok=True)
+                    results[provider] = await self._try_download(job_id, url, staging_dir, provider, progress)
+                    logger.info(f"Provider {provider}: downloaded {len(results[provider])} files")
+                except Exception as e:
+                    logger.error(f"Provider {provider} failed: {e}")
+                    results[provider] = []
+                settle()
+        
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tasks.extend(tg.create_task(attempt(p)) for p in AUDIO_PROVIDERS)
+        finally:
+            # Cancelled providers may have left truncated files behind
+            for provider in AUDIO_PROVIDERS:
+                shutil.rmtree(output_dir / f"_{provider}", ignore_errors=True)
+        
+        return winner, winner_files, tried_providers
     
     async def download_playlist(self, url: str, job_id: Optional[str] = None):
-        if not self.validate_spotify_url(url):
+        clean_url = self.parse_url(url)
+        if not clean_url:
             yield DownloadResult(
                 job_id=job_id or str(uuid.uuid4()),
                 success=False, output_dir=Path(""), song_count=0,
@@ -103,7 +292,6 @@ class SpotDLService:
         output_dir = self.DOWNLOADS_DIR / job_id
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        clean_url = self._clean_url(url)
         logger.info(f"Starting download for job {job_id}: {clean_url}")
         
         yield DownloadProgress(
@@ -111,41 +299,34 @@ class SpotDLService:
             message="Starting download with multi-provider fallback..."
         )
         
-        total_files = 0
-        tried_providers = []
+        # Relay progress from the provider race as it happens; None marks the end
+        progress: asyncio.Queue = asyncio.Queue()
+        query = await self._save_songs(clean_url, output_dir)
+        race = asyncio.create_task(self._download_with_fallback(job_id, query, output_dir, progress))
+        race.add_done_callback(lambda _: progress.put_nowait(None))
+        reported: set[str] = set()
         
-        # Try each provider
-        for provider in AUDIO_PROVIDERS:
-            try:
-                yield DownloadProgress(
-                    song_name="", status="downloading", progress=10,
-                    message=f"Trying {provider}..."
-                )
-                
-                files_before = len(list(output_dir.glob("*.mp3")))
-                await self._try_download(clean_url, output_dir, provider)
-                files_after = len(list(output_dir.glob("*.mp3")))
-                
-                new_files = files_after - files_before
-                total_files = files_after
-                tried_providers.append(provider)
-                
-                logger.info(f"Provider {provider}: downloaded {new_files} new files (total: {total_files})")
-                
-                if total_files > 0:
-                    # Got some files, we can stop or continue for more
-                    yield DownloadProgress(
-                        song_name="", status="downloading", progress=50,
-                        message=f"Downloaded {total_files} songs via {provider}"
-                    )
-                    break  # Stop after first successful provider
-                    
-            except Exception as e:
-                logger.error(f"Provider {provider} failed: {e}")
-                continue
-        
-        # Report final files
-        mp3_files = list(output_dir.glob("*.mp3"))
+        try:
+            while (update := await progress.get()) is not None:
+                if update.song_name:
+                    # Raced providers can both report the same song
+                    if update.song_name in reported:
+                        continue
+                    reported.add(update.song_name)
+                yield update
+            provider, mp3_files, tried_providers = race.result()
+        finally:
+            race.cancel()
+            # Let cancelled providers kill their spotdl processes before returning
+            await asyncio.gather(race, return_exceptions=True)
+        
+        if provider:
+            yield DownloadProgress(
+                song_name="", status="downloading", progress=50,
+                message=f"Downloaded {len(mp3_files)} songs via {provider}"
+            )
+        
+        # Only the winner's songs are final, and its files are the ground truth
         for f in mp3_files:
             yield DownloadProgress(
                 song_name=f.stem, status="completed", progress=100,
@@ -160,14 +341,13 @@ class SpotDLService:
             success=success,
             output_dir=output_dir,
             song_count=len(mp3_files),
-            error=error_msg
+            error=error_msg,
+            files=mp3_files
         )
     
     def cleanup_job(self, job_id: str):
+        for process in self._processes.pop(job_id, ()):
+            _kill(process)
         job_dir = self.DOWNLOADS_DIR / job_id
         if job_dir.exists():
             shutil.rmtree(job_dir)
-    
-    def get_job_files(self, job_id: str):
-        job_dir = self.DOWNLOADS_DIR / job_id
-        return list(job_dir.glob("*.mp3")) if job_dir.exists() else []
@@ -1,56 +1,69 @@
-"""ZIP service for creating downloadable archives."""
+"""ZIP service for streaming downloadable archives."""
 
+import io
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Iterator
 
 
-class ZipService:
-    """Service for creating ZIP archives from downloaded files."""
-    
-    ZIPS_DIR = Path("zips")
-    
+class _StreamSink(io.RawIOBase):
+    """Unseekable write target that hands back whatever ZipFile wrote so far."""
+
     def __init__(self):
-        self.ZIPS_DIR.mkdir(exist_ok=True)
-    
-    def create_zip(self, job_id: str, files: list[Path], playlist_name: Optional[str] = None) -> Path:
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ZipService:
+    """Service for streaming ZIP archives built from downloaded files."""
+
+    CHUNK_SIZE = 1024 * 1024
+    # DEFLATE saves <1% on MP3 data at a large CPU cost, so store entries as-is
+    COMPRESSION = zipfile.ZIP_STORED
+
+    def stream_zip(self, files: list[Path]) -> Iterator[bytes]:
         """
-        Create a ZIP archive from a list of files.
-        
+        Stream a ZIP archive of the given files without writing it to disk.
+
+        Entries over 4 GiB (or archives over 65535 files) use ZIP64. The next
+        chunk is read on a worker thread while the current one is sent.
+
         Args:
-            job_id: Unique job identifier
             files: List of file paths to include
-            playlist_name: Optional name for the ZIP file
-            
-        Returns:
-            Path to the created ZIP file
+
+        Yields:
+            Consecutive chunks of the ZIP archive
         """
-        zip_name = f"{playlist_name or job_id}.zip"
-        zip_path = self.ZIPS_DIR / zip_name
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        sink = _StreamSink()
+
+        with ThreadPoolExecutor(max_workers=1) as reader, \
+                zipfile.ZipFile(sink, 'w', self.COMPRESSION, allowZip64=True) as zf:
             for file_path in files:
-                if file_path.exists():
-                    # Add file with just its name (no directory structure)
-                    zf.write(file_path, file_path.name)
-        
-        return zip_path
-    
-    def get_zip_path(self, job_id: str) -> Optional[Path]:
-        """Get the path to a ZIP file if it exists."""
-        # Check for job_id.zip
-        zip_path = self.ZIPS_DIR / f"{job_id}.zip"
-        if zip_path.exists():
-            return zip_path
-        
-        # Check for any zip with job_id in name
-        for zip_file in self.ZIPS_DIR.glob(f"*{job_id}*.zip"):
-            return zip_file
-        
-        return None
-    
-    def cleanup_zip(self, job_id: str) -> None:
-        """Remove ZIP file for a job."""
-        zip_path = self.get_zip_path(job_id)
-        if zip_path and zip_path.exists():
-            zip_path.unlink()
+                # Add file with just its name (no directory structure)
+                try:
+                    zinfo = zipfile.ZipInfo.from_file(file_path, file_path.name)
+                except FileNotFoundError:
+                    continue
+                zinfo.compress_type = self.COMPRESSION
+
+                with open(file_path, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    pending = reader.submit(src.read, self.CHUNK_SIZE)
+                    while chunk := pending.result():
+                        pending = reader.submit(src.read, self.CHUNK_SIZE)
+                        dst.write(chunk)
+                        yield sink.drain()
+
+        # Trailing data descriptor and central directory
+        yield sink.drain()